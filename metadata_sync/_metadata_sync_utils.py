@@ -5,50 +5,120 @@ Created on 22May,2017
 @author: Alex
 '''
 import os
+import fnmatch
 import requests
 import logging
-from glob import glob
-from xml.dom.minidom import parseString
+from requests.adapters import HTTPAdapter
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    from urllib3.util.retry import Retry
+from lxml import etree
+
+try:
+    from concurrent.futures import ThreadPoolExecutor # Available under Python 2 via the "futures" backport package
+except ImportError:
+    ThreadPoolExecutor = None
+
+try:
+    from os import scandir # Python 3.5+
+except ImportError:
+    try:
+        from scandir import scandir # Python 2 backport package
+    except ImportError:
+        scandir = None
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)  # Initial logging level for this module
 
-def get_xml_from_uuid(geonetwork_url, uuid):
+HTTP_TIMEOUT = 30 # Seconds
+
+# Shared parser which strips inter-element whitespace so pretty_print can re-indent cleanly
+_pretty_xml_parser = etree.XMLParser(remove_blank_text=True)
+
+# Module-level session with a pooled adapter so batch runs re-use keep-alive connections
+# instead of paying a full TCP+TLS handshake per record
+_http_session = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=16,
+                            pool_maxsize=32,
+                            max_retries=Retry(total=3, backoff_factor=0.3)
+                            )
+_http_session.mount('http://', _http_adapter)
+_http_session.mount('https://', _http_adapter)
+
+def get_xml_from_uuid(geonetwork_url, uuid, session=None):
     '''
     Function to return complete, native (ISO19115-3) XML text for metadata record with specified UUID
+    An explicit requests.Session may be supplied; the shared pooled module session is used otherwise
     '''
     xml_url = '%s/xml.metadata.get?uuid=%s' % (geonetwork_url, uuid)
     logger.debug('URL = %s' % xml_url)
-    return requests.get(xml_url).content
+    return (session or _http_session).get(xml_url, timeout=HTTP_TIMEOUT).content
+
+def get_xml_from_uuids(geonetwork_url, uuids, concurrency=16):
+    '''
+    Function to fetch XML text for multiple metadata record UUIDs concurrently.
+    Fetches are latency-bound and the GIL is released during socket reads, so issuing them
+    from a thread pool over the shared keep-alive session overlaps the per-record round-trips.
+    Returns a dict of {uuid: xml_text}
+    '''
+    uuids = list(uuids)
+    if ThreadPoolExecutor and len(uuids) > 1:
+        thread_pool = ThreadPoolExecutor(max_workers=min(concurrency, len(uuids)))
+        try:
+            xml_texts = list(thread_pool.map(lambda uuid: get_xml_from_uuid(geonetwork_url, uuid), uuids))
+        finally:
+            thread_pool.shutdown()
+        return dict(zip(uuids, xml_texts))
+
+    return {uuid: get_xml_from_uuid(geonetwork_url, uuid) for uuid in uuids}
 
 def find_files(root_dir, file_template, extension_filter='.nc'):
     '''
     Function to simulate the result of a filtered Linux find command
-    Uses glob with user-friendly file system wildcards instead of regular expressions for template matching
+    Uses user-friendly file system wildcards instead of regular expressions for template matching
+    Walks the directory tree with scandir where available so that filename and file-type
+    filtering uses cached DirEntry information instead of per-file stat calls
     '''
-    #===========================================================================
-    # file_path_list = sorted([filename for filename in subprocess.check_output(
-    #     ['find', args.netcdf_dir, '-name', args.file_template]).split('\n') if re.search('\.nc$', filename)])
-    #===========================================================================
     root_dir = os.path.abspath(root_dir)
-    file_path_list = glob(os.path.join(root_dir, file_template))
-    for topdir, subdirs, _files in os.walk(root_dir, topdown=True):
-        for subdir in subdirs:
-            file_path_list += [file_path 
-                               for file_path in glob(os.path.join(topdir, subdir, file_template))
-                               if os.path.isfile(file_path)
-                               and os.path.splitext(file_path)[1] == extension_filter
+    file_path_list = []
+    if scandir:
+        dir_stack = [root_dir]
+        while dir_stack:
+            dir_path = dir_stack.pop()
+            try:
+                for entry in scandir(dir_path):
+                    if entry.is_dir(follow_symlinks=False):
+                        dir_stack.append(entry.path)
+                    elif (entry.name.endswith(extension_filter)
+                          and fnmatch.fnmatchcase(entry.name, file_template)
+                          and entry.is_file(follow_symlinks=False)
+                          ):
+                        file_path_list.append(entry.path)
+            except OSError as e: # Skip unreadable directories like os.walk does by default
+                logger.warning('WARNING: Unable to read directory %s (%s)', dir_path, e)
+    else: # Fall back to single os.walk - still avoids per-subdirectory glob calls
+        for topdir, _subdirs, files in os.walk(root_dir, topdown=True):
+            file_path_list += [os.path.join(topdir, filename)
+                               for filename in files
+                               if filename.endswith(extension_filter)
+                               and fnmatch.fnmatchcase(filename, file_template)
                                ]
-    file_path_list = sorted(file_path_list)    
-    return file_path_list
+    return sorted(file_path_list, key=str.lower)
 
 def prettify_xml(xml_text):
     '''
     Helper function to return a prettified XML string
+    Uses lxml (libxml2) instead of the pure-Python xml.dom.minidom round-trip
     '''
-    return parseString(xml_text).toprettyxml(indent="", 
-                                             newl="", 
-                                             encoding="utf-8"
-                                             )        
+    if not isinstance(xml_text, bytes):
+        # lxml refuses unicode input carrying an encoding declaration (e.g. rendered
+        # templates starting with '<?xml version="1.0" encoding="UTF-8"?>')
+        xml_text = xml_text.encode('utf-8')
+    return etree.tostring(etree.fromstring(xml_text, _pretty_xml_parser),
+                          pretty_print=True,
+                          encoding='utf-8',
+                          xml_declaration=True
+                          )
 
 
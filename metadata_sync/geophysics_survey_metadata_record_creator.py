@@ -18,18 +18,60 @@ from metadata_sync.metadata import SurveyMetadata, NetCDFMetadata #, JetCatMetad
 from geophys_utils import NetCDFGridUtils, NetCDFLineUtils
 from metadata_sync.metadata import TemplateMetadata
 from metadata_json import read_json_metadata
+from _metadata_sync_utils import find_files
 
 from metadata_sync.metadata_record_creator import MetadataRecordCreator
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)  # Initial logging level for this module
 
+ISO_DATE_REGEX = re.compile('^\d{4}-\d{2}-\d{2}')
+ISO_YEAR_REGEX = re.compile('^(\d{4})-')
+HISTORY_DATETIME_REGEX = re.compile('^(.+):.*')
 
-# Try to import Oracle metadata reader - will fail if no cx_Oracle package installed
-try:
-    from metadata_sync.metadata import ArgusMetadata
-except:
-    pass
+
+_survey_metadata_cache = {} # frozenset of survey IDs -> SurveyMetadata object
+_argus_metadata_cache = {} # (db_user, db_alias, frozenset of survey IDs) -> ArgusMetadata object
+
+def get_survey_metadata(source, use_cache=True):
+    '''
+    Factory function returning a SurveyMetadata object for the specified source.
+    Results for survey ID lists are cached keyed on the ID set so that sibling datasets
+    from the same survey(s) share a single Survey API round-trip per process
+    '''
+    cache_key = frozenset(source) if use_cache and type(source) == list else None
+    if cache_key is not None:
+        survey_metadata = _survey_metadata_cache.get(cache_key)
+        if survey_metadata is not None:
+            return survey_metadata
+
+    survey_metadata = SurveyMetadata(source)
+
+    if cache_key is not None:
+        _survey_metadata_cache[cache_key] = survey_metadata
+    return survey_metadata
+
+def get_argus_metadata(db_user, db_password, db_alias, source, use_cache=True):
+    '''
+    Factory function returning an ArgusMetadata object for the specified source.
+    Results for survey ID lists are cached keyed on DB alias, user and the ID set so that
+    sibling datasets from the same survey(s) share a single Oracle query per process
+    '''
+    cache_key = (db_user, db_alias, frozenset(source)) if use_cache and type(source) == list else None
+    if cache_key is not None:
+        argus_metadata = _argus_metadata_cache.get(cache_key)
+        if argus_metadata is not None:
+            return argus_metadata
+
+    # Deferred import so the cx_Oracle client libraries are only loaded when the Survey
+    # API fallback is actually exercised - raises ImportError without cx_Oracle installed
+    from metadata_sync.metadata._argus_metadata import ArgusMetadata
+
+    argus_metadata = ArgusMetadata(db_user, db_password, db_alias, source)
+
+    if cache_key is not None:
+        _argus_metadata_cache[cache_key] = argus_metadata
+    return argus_metadata
 
 class GeophysicsSurveyMetadataRecordCreator(MetadataRecordCreator):
     '''
@@ -44,14 +86,27 @@ class GeophysicsSurveyMetadataRecordCreator(MetadataRecordCreator):
         MetadataRecordCreator.__init__(self, xml_template_path, xml_output_path, doi_minting_mode) # Call base class consstructor
         
         self.netcdf_path = netcdf_path
-        self.netcdf_dataset = netCDF4.Dataset(self.netcdf_path, 'r+') # Allow for updating of netCDF attributes like uuid
-        
+        self.netcdf_dataset = netCDF4.Dataset(self.netcdf_path, 'r') # Read-only until an attribute update is required
+        self._netcdf_writable = False
+
         self.json_text_template_path = json_text_template_path
-        
+
         self.db_user = db_user
         self.db_password = db_password
         self.db_alias = db_alias
-    
+
+    def _get_writable_dataset(self):
+        '''
+        Helper function to lazily upgrade the netCDF dataset to read-write mode on first mutation.
+        Datasets which are only read never pay for 'r+' opening or attribute flushing.
+        N.B: Re-opens the file, so any objects holding the old dataset handle must be re-created.
+        '''
+        if not self._netcdf_writable:
+            self.netcdf_dataset.close()
+            self.netcdf_dataset = netCDF4.Dataset(self.netcdf_path, 'r+')
+            self._netcdf_writable = True
+        return self.netcdf_dataset
+
 
     def read_metadata(self):
         '''
@@ -62,11 +117,19 @@ class GeophysicsSurveyMetadataRecordCreator(MetadataRecordCreator):
         netcdf_metadata.read_netcdf_metadata(self.netcdf_dataset)
         self.metadata_object.merge_root_metadata_from_object(netcdf_metadata)
 
+        def survey_id_set(survey_id_string):
+            '''
+            Helper function to parse a comma-separated survey ID string into a set of ints
+            '''
+            return set([int(value_string.strip()) for value_string in survey_id_string.split(',') if value_string.strip()])
+
         # JetCat and Survey metadata can either take a list of survey IDs as source(s) or a filename from which to parse them
+        netcdf_survey_ids = None # Parsed once here and reused for the consistency check below
         try:
             survey_ids = self.netcdf_dataset.survey_id
             logger.info('Survey ID "%s" found in netCDF attributes' % survey_ids)
-            source = [int(value_string.strip()) for value_string in survey_ids.split(',') if value_string.strip()]
+            netcdf_survey_ids = survey_id_set(str(survey_ids))
+            source = sorted(netcdf_survey_ids)
         except:
             source = self.netcdf_path
     
@@ -74,24 +137,22 @@ class GeophysicsSurveyMetadataRecordCreator(MetadataRecordCreator):
     #    metadata_object.merge_root_metadata_from_object(jetcat_metadata)
     
         try:
-            survey_metadata = SurveyMetadata(source)
+            survey_metadata = get_survey_metadata(source)
             self.metadata_object.merge_root_metadata_from_object(survey_metadata)
         except Exception as e:
             logger.warning('Unable to read from Survey API:\n%s\nAttempting direct Oracle DB read' % e.message)
             try:
-                survey_metadata = ArgusMetadata(self.db_user, self.db_password, self.db_alias, source) # This will fail if we haven't been able to import ArgusMetadata 
+                survey_metadata = get_argus_metadata(self.db_user, self.db_password, self.db_alias, source) # This will fail if ArgusMetadata can't be imported (no cx_Oracle)
                 self.metadata_object.merge_root_metadata('Survey', survey_metadata.metadata_dict, overwrite=True) # Fake Survey metadata from DB query
             except Exception as e:
                 logger.error('Unable to perform direct Oracle DB read: %s' % e.message)
     
         survey_id = self.metadata_object.get_metadata(['Survey', 'SURVEYID'])
         try:
-            dataset_survey_id = str(self.netcdf_dataset.survey_id)
-            assert (set([int(value_string.strip()) for value_string in dataset_survey_id.split(',') if value_string.strip()]) == 
-                    set([int(value_string.strip()) for value_string in survey_id.split(',') if value_string.strip()])), 'NetCDF survey ID %s is inconsistent with %s' % (dataset_survey_id, survey_id)
+            assert netcdf_survey_ids is not None, 'No survey ID found in netCDF attributes'
+            assert netcdf_survey_ids == survey_id_set(survey_id), 'NetCDF survey ID %s is inconsistent with %s' % (sorted(netcdf_survey_ids), survey_id)
         except:
-            self.netcdf_dataset.survey_id = str(survey_id)
-            self.netcdf_dataset.sync()
+            self._get_writable_dataset().survey_id = str(survey_id) # Sync deferred until the end of populate_template_values
             logger.info('Survey ID %s written to netCDF file' % survey_id)
 
     
@@ -115,8 +176,7 @@ class GeophysicsSurveyMetadataRecordCreator(MetadataRecordCreator):
                 dataset_uuid = str(uuid.uuid4())
                 logger.debug('dataset_uuid = %s' % dataset_uuid)
                 
-            self.netcdf_dataset.uuid = dataset_uuid
-            self.netcdf_dataset.sync()
+            self._get_writable_dataset().uuid = dataset_uuid # Sync deferred until the end of populate_template_values
             logger.info('UUID %s written to netCDF file' % dataset_uuid)
                 
             return dataset_uuid   
@@ -129,13 +189,25 @@ class GeophysicsSurveyMetadataRecordCreator(MetadataRecordCreator):
                                        ) 
             logger.info('DOI "%s" minted' % dataset_doi)
             if dataset_doi and self.doi_minting_mode == 'prod':
-                self.netcdf_dataset.doi = dataset_doi
-                self.netcdf_dataset.sync()
+                self._get_writable_dataset().doi = dataset_doi # Sync deferred until the end of populate_template_values
                 logger.info('Freshly-minted DOI "%s" written to NetCDF file' % dataset_doi)
         
             return dataset_doi
-        
-        
+
+        def get_extreme_date(multi_date_string, extreme_function):
+            '''
+            Helper function to find the earliest/latest date in a comma-separated date string.
+            ISO-8601 dates sort lexicographically, so when all elements look ISO we can take the
+            extreme of the raw strings and parse only that one value instead of parsing them all
+            '''
+            date_strings = [date_string.strip() for date_string in multi_date_string.split(',') if date_string.strip()]
+            if date_strings and all(ISO_DATE_REGEX.match(date_string) for date_string in date_strings):
+                try:
+                    return datetime.strptime(extreme_function(date_strings)[:10], '%Y-%m-%d').date()
+                except ValueError: # Not a real date despite matching the ISO pattern - parse everything
+                    pass
+            return extreme_function(self.str2datelist(multi_date_string))
+
         calculated_values = {}
         # Splice the calculated_values dict directly into self.metadata_object.metadata_dict 
         self.metadata_object.metadata_dict['Calculated'] = calculated_values 
@@ -154,30 +226,32 @@ class GeophysicsSurveyMetadataRecordCreator(MetadataRecordCreator):
             netcdf_utils = NetCDFLineUtils(self.netcdf_dataset)
             logger.info('%s is a line dataset' % self.netcdf_path)
             
-        WGS84_extents = [min([coordinate[0] for coordinate in netcdf_utils.wgs84_bbox]),
-                         min([coordinate[1] for coordinate in netcdf_utils.wgs84_bbox]),
-                         max([coordinate[0] for coordinate in netcdf_utils.wgs84_bbox]),
-                         max([coordinate[1] for coordinate in netcdf_utils.wgs84_bbox])
+        # Single traversal of the bbox ring instead of four separate list comprehensions
+        x_ordinates, y_ordinates = zip(*netcdf_utils.wgs84_bbox)
+        WGS84_extents = [min(x_ordinates),
+                         min(y_ordinates),
+                         max(x_ordinates),
+                         max(y_ordinates)
                          ]
-            
+
         calculated_values['WLON'] = str(WGS84_extents[0])
         calculated_values['SLAT'] = str(WGS84_extents[1])
         calculated_values['ELON'] = str(WGS84_extents[2])
         calculated_values['NLAT'] = str(WGS84_extents[3])
         
         try:
-            calculated_values['START_DATE'] = min(self.str2datelist(str(self.metadata_object.get_metadata(['Survey', 'STARTDATE'])))).isoformat()
+            calculated_values['START_DATE'] = get_extreme_date(str(self.metadata_object.get_metadata(['Survey', 'STARTDATE'])), min).isoformat()
         except ValueError:
-            calculated_values['START_DATE'] = None   
-        
+            calculated_values['START_DATE'] = None
+
         try:
-            calculated_values['END_DATE'] = max(self.str2datelist(str(self.metadata_object.get_metadata(['Survey', 'ENDDATE'])))).isoformat()
+            calculated_values['END_DATE'] = get_extreme_date(str(self.metadata_object.get_metadata(['Survey', 'ENDDATE'])), max).isoformat()
         except ValueError:
-            calculated_values['END_DATE'] = None 
+            calculated_values['END_DATE'] = None
         
         # Find survey year from end date isoformat string
         try:
-            calculated_values['YEAR'] = re.match('^(\d{4})-', calculated_values['END_DATE']).group(1)
+            calculated_values['YEAR'] = ISO_YEAR_REGEX.match(calculated_values['END_DATE']).group(1)
         except:
             calculated_values['YEAR'] = 'UNKNOWN' 
         
@@ -185,7 +259,7 @@ class GeophysicsSurveyMetadataRecordCreator(MetadataRecordCreator):
         #date_modified = "2016-08-29T10:51:42"
         try:
             try:
-                conversion_datetime_string = re.match('^(.+):.*', str(self.metadata_object.get_metadata(['NetCDF', 'history']))).group(1)
+                conversion_datetime_string = HISTORY_DATETIME_REGEX.match(str(self.metadata_object.get_metadata(['NetCDF', 'history']))).group(1)
                 conversion_datetime_string = datetime.strptime(conversion_datetime_string, '%a %b %d %H:%M:%S %Y').isoformat()
             except:
                 conversion_datetime_string = self.metadata_object.get_metadata(['NetCDF', 'date_modified']) or 'UNKNOWN'
@@ -201,35 +275,128 @@ class GeophysicsSurveyMetadataRecordCreator(MetadataRecordCreator):
         if not calculated_values['DOI']:
             calculated_values['DOI'] = get_doi()
 
+        # Flush any deferred netCDF attribute updates (survey_id/uuid/doi) in one sync
+        if self._netcdf_writable:
+            self.netcdf_dataset.sync()
+
         # Populate final template
         template_metadata_object = TemplateMetadata(self.json_text_template_path, self.metadata_object)
         self.metadata_object.merge_root_metadata_from_object(template_metadata_object)
-    
+
+
+class GeophysicsSurveyMetadataBatchCreator(object):
+    '''
+    Batch XML metadata record creator for multiple geophysical survey datasets.
+    Files are grouped by survey ID set so survey metadata is fetched once per group
+    (via the module-level metadata caches) instead of once per file
+    '''
+    def __init__(self, xml_template_path, xml_output_dir, netcdf_path_list, json_text_template_path,
+                 doi_minting_mode='test',
+                 db_user=None, db_password=None, db_alias=None):
+        '''
+        GeophysicsSurveyMetadataBatchCreator Constructor
+        '''
+        self.xml_template_path = xml_template_path
+        self.xml_output_dir = xml_output_dir
+        self.netcdf_path_list = list(netcdf_path_list)
+        self.json_text_template_path = json_text_template_path
+        self.doi_minting_mode = doi_minting_mode
+
+        self.db_user = db_user
+        self.db_password = db_password
+        self.db_alias = db_alias
+
+    def get_netcdf_survey_ids(self, netcdf_path):
+        '''
+        Helper function to read the survey ID set from a netCDF file. Returns None when
+        no survey_id attribute is defined (such files fall back to filename parsing)
+        '''
+        try:
+            netcdf_dataset = netCDF4.Dataset(netcdf_path, 'r')
+            try:
+                survey_ids = str(netcdf_dataset.survey_id)
+            finally:
+                netcdf_dataset.close()
+            return frozenset([int(value_string.strip()) for value_string in survey_ids.split(',') if value_string.strip()])
+        except:
+            return None
+
+    def create_records(self):
+        '''
+        Function to create one XML metadata record per netCDF file, processing files
+        grouped by survey ID set
+        '''
+        survey_groups = {}
+        for netcdf_path in self.netcdf_path_list:
+            survey_groups.setdefault(self.get_netcdf_survey_ids(netcdf_path), []).append(netcdf_path)
+
+        for survey_ids, netcdf_path_group in survey_groups.items():
+            if survey_ids:
+                try: # Pre-warm the survey metadata cache with one API call per group
+                    get_survey_metadata(sorted(survey_ids))
+                except Exception as e:
+                    logger.warning('Unable to pre-fetch survey metadata for survey IDs %s: %s' % (sorted(survey_ids), e.message))
+
+            for netcdf_path in netcdf_path_group:
+                xml_output_path = os.path.join(self.xml_output_dir,
+                                               os.path.splitext(os.path.basename(netcdf_path))[0] + '.xml')
+                try:
+                    record_creator = GeophysicsSurveyMetadataRecordCreator(xml_template_path=self.xml_template_path,
+                                                                           xml_output_path=xml_output_path,
+                                                                           netcdf_path=netcdf_path,
+                                                                           json_text_template_path=self.json_text_template_path,
+                                                                           doi_minting_mode=self.doi_minting_mode,
+                                                                           db_alias=self.db_alias,
+                                                                           db_user=self.db_user,
+                                                                           db_password=self.db_password
+                                                                           )
+                    record_creator.output_xml()
+                except Exception as e:
+                    logger.error('XML record creation failed for %s: %s' % (netcdf_path, e.message))
+
+
 def main():
     # Define command line arguments
     parser = argparse.ArgumentParser()
     
     parser.add_argument("-j", "--json_template", help="JSON text template path", type=str, required=True)
     parser.add_argument("-t", "--xml_template", help="XML template path", type=str, required=True)
-    parser.add_argument("-n", "--netcdf", help="netcdf file path", type=str, required=True)
-    parser.add_argument("-o", "--output", help="XML output path", type=str, required=True)
+    parser.add_argument("-n", "--netcdf", help="netcdf file path", type=str)
+    parser.add_argument("-N", "--netcdf_dir", help="NetCDF root directory for batch mode", type=str)
+    parser.add_argument("-f", "--file_template", help='NetCDF filename template for batch mode (default="*.nc")', type=str, default="*.nc")
+    parser.add_argument("-o", "--output", help="XML output path (output directory in batch mode)", type=str, required=True)
     parser.add_argument("-m", "--doi_mode", help="DOI minting mode (test or prod)", type=str, default='test')
     parser.add_argument("-d", "--db_alias", help="Oracle DB alias (optional)", type=str)
     parser.add_argument("-u", "--db_user", help="Oracle DB user (optional)", type=str)
     parser.add_argument("-p", "--db_password", help="Oracle DB password (optional)", type=str)
     
     args = parser.parse_args()
-    
+
+    assert args.netcdf or args.netcdf_dir, 'Either --netcdf or --netcdf_dir must be specified'
+
+    if args.netcdf_dir: # Batch mode - find all matching netCDF files and group them by survey
+        batch_creator = GeophysicsSurveyMetadataBatchCreator(xml_template_path=args.xml_template,
+                                                             xml_output_dir=args.output,
+                                                             netcdf_path_list=find_files(args.netcdf_dir, args.file_template),
+                                                             json_text_template_path=args.json_template,
+                                                             doi_minting_mode=args.doi_mode,
+                                                             db_alias=args.db_alias,
+                                                             db_user=args.db_user,
+                                                             db_password=args.db_password
+                                                             )
+        batch_creator.create_records()
+        return
+
     record_creator = GeophysicsSurveyMetadataRecordCreator(xml_template_path=args.xml_template,
-                                                           xml_output_path=args.output, 
-                                                           netcdf_path=args.netcdf, 
+                                                           xml_output_path=args.output,
+                                                           netcdf_path=args.netcdf,
                                                            json_text_template_path=args.json_template,
                                                            doi_minting_mode=args.doi_mode,
                                                            db_alias=args.db_alias,
-                                                           db_user=args.db_user, 
+                                                           db_user=args.db_user,
                                                            db_password=args.db_password
                                                            )
-        
+
     logger.debug('record_creator.__dict__ = %s' % record_creator.__dict__)
     record_creator.output_xml()
 
@@ -8,10 +8,9 @@ from _netcdf_metadata import NetCDFMetadata
 from _jetcat_metadata import JetCatMetadata
 from _survey_metadata import SurveyMetadata
 
-try:
-    from _argus_metadata import ArgusMetadata # This needs cx_Oracle - can't run outside GA
-except:
-    pass
+# N.B: ArgusMetadata is deliberately NOT imported here - it needs cx_Oracle (can't run
+# outside GA) and loading the Oracle client libraries costs time on every package import.
+# Import it lazily from metadata_sync.metadata._argus_metadata at the point of use.
 
 
 def metadata_class(metadata_type_tag):
@@ -26,6 +25,7 @@ def metadata_class(metadata_type_tag):
                           }
 
     try:
+        from _argus_metadata import ArgusMetadata # Deferred - needs cx_Oracle
         metadata_class_map['Argus'] = ArgusMetadata
     except:
         pass
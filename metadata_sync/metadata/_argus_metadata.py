@@ -80,6 +80,10 @@ where A.SURVEYS.SURVEYID in ({SURVEY_IDS})'''
     
     MIN_SURVEY_ID = 20
 
+    # Default row prefetch count. The cx_Oracle default is very low, so bulk reads over
+    # WAN connections pay a network round-trip per few rows without this
+    DEFAULT_PREFETCH_ROWS = 1000
+
     type_dict = {'g': 'GRAV',
                  'm': 'MAG',
                  'r': 'RAD'
@@ -100,16 +104,21 @@ where A.SURVEYS.SURVEYID in ({SURVEY_IDS})'''
                 ArgusMetadata.state_dict.get(state_tag[0:2]) or 
                 state_tag)
 
-    def __init__(self, db_user, db_password, db_alias, source=None):
+    def __init__(self, db_user, db_password, db_alias, source=None, prefetch_rows=DEFAULT_PREFETCH_ROWS):
         """Instantiates ArgusMetadata object. Overrides Metadata method
         """
         self._metadata_dict = {}
 
         self.argus_fields = None
-                
+
         self.connection = cx_Oracle.connect('%s/%s@%s' % (db_user, db_password, db_alias))
         self.cursor = self.connection.cursor()
-        
+        self.cursor.arraysize = prefetch_rows
+        try:
+            self.cursor.prefetchrows = prefetch_rows # cx_Oracle >= 7 only
+        except AttributeError:
+            pass
+
         if source:
             if isinstance(source, dict):
                 self._metadata_dict = source
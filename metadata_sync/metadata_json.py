@@ -9,15 +9,59 @@ import dateutil.parser
 from datetime import datetime
 from dateutil import tz
 import pytz
-from glob import glob
 import hashlib
 import logging
+import mmap
+import multiprocessing
+
+try:
+    from concurrent.futures import ThreadPoolExecutor # Available under Python 2 via the "futures" backport package
+except ImportError:
+    ThreadPoolExecutor = None
+
+try:
+    from os import scandir # Python 3.5+
+except ImportError:
+    try:
+        from scandir import scandir # Python 2 backport package
+    except ImportError:
+        scandir = None
+
+try:
+    import orjson # Optional native JSON implementation - several times faster than stdlib json
+except ImportError:
+    orjson = None
+
+try:
+    import blake3 # Optional SIMD-vectorized hash - much faster than MD5 for integrity checking
+except ImportError:
+    blake3 = None
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)  # Initial logging level for this module
 
 DEFAULT_EXCLUDED_EXTENSIONS = ['.bck', '.md5', '.uuid', '.json', '.tmp']
 
+MAX_HASH_THREADS = min(8, multiprocessing.cpu_count())
+
+# Checksums are only used for drift detection, not cryptographic security, so prefer
+# the much faster BLAKE3 when available. MD5 remains the default for verifying
+# .metadata.json files written before the hash_algorithm field was recorded.
+DEFAULT_HASH_ALGORITHM = 'blake3' if blake3 else 'md5'
+
+def get_hasher(hash_algorithm):
+    '''
+    Helper function to return a new hasher object for the specified algorithm name
+    '''
+    if hash_algorithm == 'blake3':
+        assert blake3, 'blake3 package is not installed'
+        return blake3.blake3()
+    return hashlib.new(hash_algorithm)
+
+MAX_CACHED_METADATA_DICTS = 256
+
+_json_metadata_cache = {} # (dataset_folder, mtime) -> metadata_dict
+
 def read_iso_datetime_string(iso_datetime_string):
     '''
     Helper function to convert an ISO datetime string into a Python datetime object
@@ -43,44 +87,86 @@ def get_iso_utcnow(utc_datetime=None):
         tzinfo=tz.gettz('UTC')).isoformat()
 
 
-def get_utc_mtime(file_path):
+def get_utc_mtime(file_path, file_stat=None):
     '''
-    Helper function to return the UTC modification time for a specified file
+    Helper function to return the UTC modification time for a specified file.
+    A pre-fetched os.stat result may be passed in to avoid any filesystem access here
     '''
-    assert file_path and os.path.exists(
-        file_path), 'Invalid file path "%s"' % file_path
-    return datetime.fromtimestamp(os.path.getmtime(file_path), pytz.utc)
+    if file_stat is None:
+        assert file_path, 'Invalid file path "%s"' % file_path
+        file_stat = os.stat(file_path) # Single stat call - raises OSError for invalid paths
+    return datetime.fromtimestamp(file_stat.st_mtime, pytz.utc)
 
 
 
-def get_filtered_md5sum_dict(md5dir, excluded_extensions=[]):
+def _scan_dataset_files(dataset_folder, excluded_extensions):
+    '''
+    Helper generator yielding (file name, file path, stat result) tuples for each dataset
+    file in dataset_folder, excluding hidden files and files with excluded extensions.
+    Uses a single scandir pass with cached stat information where scandir is available
+    '''
+    if scandir:
+        for entry in scandir(dataset_folder):
+            if (not entry.name.startswith('.') # Match glob semantics - ignore hidden files
+                and os.path.splitext(entry.name)[1] not in excluded_extensions
+                and entry.is_file(follow_symlinks=False)
+                ):
+                yield entry.name, entry.path, entry.stat()
+    else:
+        for file_name in os.listdir(dataset_folder):
+            file_path = os.path.join(dataset_folder, file_name)
+            if (not file_name.startswith('.')
+                and os.path.splitext(file_name)[1] not in excluded_extensions
+                and os.path.isfile(file_path)
+                ):
+                yield file_name, file_path, os.stat(file_path)
+
+def get_filtered_md5sum_dict(md5dir, excluded_extensions=[], hash_algorithm='md5'):
     '''
     Simulate filtered Linux md5sum command on md5dir directory
     '''
-    return get_md5sums([fname for fname in glob(os.path.join(md5dir, '*'))
-                        if os.path.isfile(fname)
-                        and os.path.splitext(fname)[1] not in excluded_extensions
-                        ]
+    return get_md5sums([file_path
+                        for _file_name, file_path, _file_stat in _scan_dataset_files(md5dir, excluded_extensions)
+                        ],
+                       hash_algorithm=hash_algorithm
                        )
-    
-def get_md5sums(file_path_list, ashexstr=True):
-    '''
-    Generate MD5 checksums for all files named in file_path_list
-    Code adapted from http://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
-    '''
-    def hash_bytestr_iter(bytesiter, hasher, ashexstr=ashexstr):
-        for block in bytesiter:
-            hasher.update(block)
-        return (hasher.hexdigest() if ashexstr else hasher.digest())
-     
-    def file_as_blockiter(afile, blocksize=65536):
-        with afile:
-            block = afile.read(blocksize)
-            while len(block) > 0:
-                yield block
-                block = afile.read(blocksize)
-                
-    return {os.path.basename(fname): hash_bytestr_iter(file_as_blockiter(open(fname, 'rb')), hashlib.md5())
+
+def get_md5sums(file_path_list, ashexstr=True, blocksize=1048576, hash_algorithm='md5'):
+    '''
+    Generate checksums for all files named in file_path_list using the specified hash algorithm
+    (MD5 by default for backward compatibility). hashlib avoids the fork & stdout-parsing
+    overhead of shelling out to the md5sum command
+    '''
+    def md5_file(file_path):
+        hasher = get_hasher(hash_algorithm)
+        with open(file_path, 'rb', 0) as infile: # Unbuffered - reading large blocks directly
+            try: # Memory-map non-empty files so the page cache is handed straight to the hasher without copies
+                memory_map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error): # Empty file or mmap unsupported by filesystem
+                block = infile.read(blocksize)
+                while block:
+                    hasher.update(block)
+                    block = infile.read(blocksize)
+            else:
+                try:
+                    if hasattr(memory_map, 'madvise'): # Python 3.8+
+                        memory_map.madvise(mmap.MADV_SEQUENTIAL)
+                    hasher.update(memory_map) # mmap supports the buffer interface - no intermediate copies
+                finally:
+                    memory_map.close()
+        return hasher.hexdigest() if ashexstr else hasher.digest()
+
+    # hashlib.md5().update releases the GIL for large blocks, so hashing multiple
+    # files in threads scales with disk bandwidth
+    if ThreadPoolExecutor and len(file_path_list) > 1:
+        thread_pool = ThreadPoolExecutor(max_workers=min(MAX_HASH_THREADS, len(file_path_list)))
+        try:
+            md5sums = list(thread_pool.map(md5_file, file_path_list))
+        finally:
+            thread_pool.shutdown()
+        return dict(zip([os.path.basename(fname) for fname in file_path_list], md5sums))
+
+    return {os.path.basename(fname): md5_file(fname)
             for fname in file_path_list
             }
 
@@ -95,27 +181,42 @@ def write_json_metadata(uuid, dataset_folder, excluded_extensions=None):
     dataset_folder = os.path.abspath(dataset_folder)
 
     json_metadata_path = os.path.join(dataset_folder, '.metadata.json')
-    md5_dict = get_filtered_md5sum_dict(dataset_folder, excluded_extensions)
+
+    # Single directory pass collects names, paths and mtimes together, so checksumming is
+    # the only subsequent per-file I/O - no re-listing or re-statting
+    file_info_list = sorted(_scan_dataset_files(dataset_folder, excluded_extensions))
+    md5_dict = get_md5sums([file_path for _file_name, file_path, _file_stat in file_info_list],
+                           hash_algorithm=DEFAULT_HASH_ALGORITHM)
+
     metadata_dict = {'uuid': uuid,
                      'time': get_iso_utcnow(),
                      'folder_path': dataset_folder,
-                     'files': [{'file': os.path.basename(filename),
-                                'md5': md5_dict[filename],
-                                'mtime': get_utc_mtime(os.path.join(dataset_folder, filename)).isoformat()
+                     'hash_algorithm': DEFAULT_HASH_ALGORITHM,
+                     'files': [{'file': file_name,
+                                'md5': md5_dict[file_name],
+                                'mtime': get_utc_mtime(file_path, file_stat).isoformat()
                                 }
-                               for filename in sorted(md5_dict.keys())
+                               for file_name, file_path, file_stat in file_info_list
                                ]
                      }
 
-    json_output_file = open(json_metadata_path, 'w')
-    json.dump(metadata_dict, json_output_file, indent=4)
-    json_output_file.close()
+    if orjson:
+        json_output_file = open(json_metadata_path, 'wb')
+        json_output_file.write(orjson.dumps(metadata_dict, option=orjson.OPT_INDENT_2))
+        json_output_file.close()
+    else:
+        json_output_file = open(json_metadata_path, 'w')
+        json.dump(metadata_dict, json_output_file, indent=4)
+        json_output_file.close()
     logger.info('Finished writing metadata file %s', json_metadata_path)
 
 
 def read_json_metadata(dataset_folder):
     '''
     Function to read metadata_dict from .metadata.json
+    Results are cached per (folder, mtime) so re-reads of an unchanged file within
+    the same process avoid repeated json parsing. N.B: Callers must treat the
+    returned dict as read-only.
     '''
     assert os.path.isdir(
         dataset_folder), 'dataset_folder is not a valid directory.'
@@ -123,11 +224,26 @@ def read_json_metadata(dataset_folder):
 
     json_metadata_path = os.path.join(dataset_folder, '.metadata.json')
 
-    json_metadata_file = open(json_metadata_path, 'r')
-    metadata_dict = json.load(json_metadata_file)
-    json_metadata_file.close()
+    # Cache key includes mtime so rewriting .metadata.json implicitly invalidates the cached entry
+    cache_key = (dataset_folder, os.stat(json_metadata_path).st_mtime)
+    metadata_dict = _json_metadata_cache.get(cache_key)
+    if metadata_dict is not None:
+        return metadata_dict
 
-    return metadata_dict    
+    if orjson:
+        json_metadata_file = open(json_metadata_path, 'rb')
+        metadata_dict = orjson.loads(json_metadata_file.read())
+        json_metadata_file.close()
+    else:
+        json_metadata_file = open(json_metadata_path, 'r')
+        metadata_dict = json.load(json_metadata_file)
+        json_metadata_file.close()
+
+    if len(_json_metadata_cache) >= MAX_CACHED_METADATA_DICTS:
+        _json_metadata_cache.clear()
+    _json_metadata_cache[cache_key] = metadata_dict
+
+    return metadata_dict
 
 
 def check_json_metadata(uuid, dataset_folder, excluded_extensions=None):
@@ -148,18 +264,26 @@ def check_json_metadata(uuid, dataset_folder, excluded_extensions=None):
         report_list.append('Dataset folder Changed from %s to %s' % (
             metadata_dict['folder_path'], dataset_folder))
 
-    calculated_md5_dict = get_filtered_md5sum_dict(dataset_folder, excluded_extensions)
+    # Re-hash with whatever algorithm the metadata file was written with (pre-existing
+    # files without a hash_algorithm field were always MD5)
+    calculated_md5_dict = get_filtered_md5sum_dict(dataset_folder, excluded_extensions,
+                                                   hash_algorithm=metadata_dict.get('hash_algorithm', 'md5'))
 
     saved_md5_dict = {file_dict['file']:
                       file_dict['md5']
                       for file_dict in metadata_dict['files']
                       }
 
+    # Invert the calculated checksums once so renamed-file lookups are O(1) rather than
+    # a scan of all calculated checksums per missing file
+    filenames_by_md5sum = {}
+    for calculated_filename, calculated_md5sum in calculated_md5_dict.items():
+        filenames_by_md5sum.setdefault(calculated_md5sum, []).append(calculated_filename)
+
     for saved_filename, saved_md5sum in saved_md5_dict.items():
         calculated_md5sum = calculated_md5_dict.get(saved_filename)
         if not calculated_md5sum:
-            new_filenames = [new_filename for new_filename, new_md5sum in calculated_md5_dict.items(
-            ) if new_md5sum == saved_md5sum]
+            new_filenames = sorted(filenames_by_md5sum.get(saved_md5sum, []))
             if new_filenames:
                 report_list.append('File %s has been renamed to %s' % (
                     saved_filename, new_filenames[0]))
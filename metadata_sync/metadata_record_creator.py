@@ -15,6 +15,37 @@ from _metadata_sync_utils import prettify_xml
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)  # Initial logging level for this module
 
+# Matches template keys like KEYWORD_THEME_LIST, capturing the middle token so the
+# corresponding KEYWORD_<token>_CODE key can be built without a second regex call
+KEYWORD_LIST_REGEX = re.compile('^KEYWORD_(\w+)_LIST$')
+
+DATE_ONLY_FORMAT = '%d-%b-%y'
+DATETIME_FORMATS = (DATE_ONLY_FORMAT,
+                    '%Y-%m-%dT%H:%M:%S',
+                    '%Y-%m-%dT%H:%M:%S.%f',
+                    '%Y-%m-%dT%H:%M:%S%z',
+                    '%Y-%m-%dT%H:%M:%S.%f%z'
+                    )
+
+_jinja_environment_cache = {} # template_dir -> jinja2.Environment
+
+def _get_jinja_environment(template_dir):
+    '''
+    Helper function returning a shared jinja2 Environment per template directory.
+    Re-using the Environment lets jinja2's internal template cache skip re-compiling
+    templates on every get_xml_text call
+    '''
+    jinja_environment = _jinja_environment_cache.get(template_dir)
+    if jinja_environment is None:
+        jinja_environment = Environment(
+            loader=FileSystemLoader(template_dir),
+            autoescape=select_autoescape(['html', 'xml']),
+            auto_reload=False, # Template files don't change mid-run - skip mtime checks
+            cache_size=400
+            )
+        _jinja_environment_cache[template_dir] = jinja_environment
+    return jinja_environment
+
 
 class MetadataRecordCreator(object):
     '''
@@ -37,13 +68,9 @@ class MetadataRecordCreator(object):
         '''
         #template_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'templates')
         template_dir = os.path.dirname(self.xml_template_path)
-        
-        jinja_environment = Environment(
-            loader=FileSystemLoader(template_dir),
-            autoescape=select_autoescape(['html', 'xml']
-                                         )
-                                        )
-            
+
+        jinja_environment = _get_jinja_environment(template_dir)
+
         xml_template = jinja_environment.get_template(os.path.basename(self.xml_template_path), parent=None)
         
         # Call functions to read available metadata and populate template values
@@ -55,60 +82,81 @@ class MetadataRecordCreator(object):
         # Convert multiple sets of comma-separated lists to lists of strings to a list of dicts
         #TODO: Make this slicker
         value_dict['keywords'] = []
-        for keyword_list_key in [key for key in value_dict.keys() if re.match('^KEYWORD_\w+_LIST$', key)]:
-            keywords = [keyword.strip() for keyword in value_dict[keyword_list_key].split(',')]
-            keyword_code = value_dict[re.sub('_LIST$', '_CODE', keyword_list_key)]
-            
-            value_dict['keywords'] += [{'value': keyword,
-                                        'code': keyword_code
-                                        } for keyword in keywords
-                                       ]
+        for key, keyword_list_string in value_dict.items():
+            match = KEYWORD_LIST_REGEX.match(key)
+            if not match:
+                continue
+            keyword_code = value_dict['KEYWORD_%s_CODE' % match.group(1)]
+
+            # Generator expression - extends in place without building a throwaway list
+            value_dict['keywords'].extend({'value': keyword.strip(),
+                                           'code': keyword_code
+                                           } for keyword in keyword_list_string.split(',')
+                                          )
         
         # Create dict containing distribution info for DOI if required
         value_dict['distributions'] = []
         dataset_doi = self.metadata_object.get_metadata(['Calculated', 'DOI'])
         if dataset_doi:
             try:
+                # Read ORGANISATION_* values straight from the template snapshot taken above
+                # instead of re-walking the metadata tree via get_metadata for each key
                 distribution_dict = {'formatSpecification': 'html',
-                                     'distributor_name': self.metadata_object.get_metadata(['Template', 'ORGANISATION_NAME']),
-                                     'distributor_telephone': self.metadata_object.get_metadata(['Template', 'ORGANISATION_PHONE']),
-                                     'distributor_address': self.metadata_object.get_metadata(['Template', 'ORGANISATION_ADDRESS']),
-                                     'distributor_city': self.metadata_object.get_metadata(['Template', 'ORGANISATION_CITY']),
-                                     'distributor_state': self.metadata_object.get_metadata(['Template', 'ORGANISATION_STATE']),
-                                     'distributor_postcode': self.metadata_object.get_metadata(['Template', 'ORGANISATION_POSTCODE']),
-                                     'distributor_country': self.metadata_object.get_metadata(['Template', 'ORGANISATION_COUNTRY']),
-                                     'distributor_email': self.metadata_object.get_metadata(['Template', 'ORGANISATION_EMAIL']),
+                                     'distributor_name': value_dict.get('ORGANISATION_NAME'),
+                                     'distributor_telephone': value_dict.get('ORGANISATION_PHONE'),
+                                     'distributor_address': value_dict.get('ORGANISATION_ADDRESS'),
+                                     'distributor_city': value_dict.get('ORGANISATION_CITY'),
+                                     'distributor_state': value_dict.get('ORGANISATION_STATE'),
+                                     'distributor_postcode': value_dict.get('ORGANISATION_POSTCODE'),
+                                     'distributor_country': value_dict.get('ORGANISATION_COUNTRY'),
+                                     'distributor_email': value_dict.get('ORGANISATION_EMAIL'),
                                      'url': dataset_doi,
                                      'protocol': 'WWW:LINK-1.0-http--link',
                                      'name': 'Digital Object Identifier for dataset %s' % self.metadata_object.get_metadata(['Calculated', 'UUID']),
                                      'description': 'Dataset DOI'
                                      }
-                
-                for key, value in distribution_dict.iteritems():
-                    assert value, '%s has no value defined' % key
-                
+
+                missing_keys = sorted([key for key, value in distribution_dict.items() if not value])
+                assert not missing_keys, '%s has no value defined' % ', '.join(missing_keys)
+
                 value_dict['distributions'].append(distribution_dict)
             except Exception as e:
-                logger.warning('WARNING: Unable to create DOI distribution: %s' % e.message)
+                logger.warning('WARNING: Unable to create DOI distribution: %s', e.message)
         
-        logger.debug('value_dict = %s' % value_dict)
-        return self.prettify_xml(xml_template.render(**value_dict))
+        if logger.isEnabledFor(logging.DEBUG): # Skip formatting the (large) dict repr entirely when DEBUG is off
+            logger.debug('value_dict = %s', value_dict)
+        # Single lxml parse+serialize - much faster than the old minidom round-trip
+        return prettify_xml(xml_template.render(**value_dict))
     
     def str2datetimelist(self, multi_datetime_string):
         '''
         Helper function to convert comma-separated string containing dates to a list of datetimes
         '''
-        datetime_format_list = ['%d-%b-%y', 
-                                '%Y-%m-%dT%H:%M:%S', 
-                                '%Y-%m-%dT%H:%M:%S.%f', 
-                                '%Y-%m-%dT%H:%M:%S%z', 
-                                '%Y-%m-%dT%H:%M:%S.%f%z'
-                                ]
+        def candidate_formats(datetime_string):
+            '''
+            Helper function returning the most likely format first so the common case parses
+            on the first strptime attempt instead of raising through the whole format list
+            '''
+            if 'T' not in datetime_string: # Not ISO 8601
+                return (DATE_ONLY_FORMAT,)
+
+            best_format = ('%Y-%m-%dT%H:%M:%S.%f' if '.' in datetime_string
+                           else '%Y-%m-%dT%H:%M:%S')
+            if len(datetime_string) > 19 and ('+' in datetime_string[19:] or '-' in datetime_string[19:]):
+                best_format += '%z' # Timezone suffix present
+            return (best_format,) + tuple(datetime_format
+                                          for datetime_format in DATETIME_FORMATS
+                                          if datetime_format != best_format
+                                          )
+
         date_list = []
         for datetime_string in multi_datetime_string.split(','):
-            for datetime_format in datetime_format_list:
+            datetime_string = datetime_string.strip()
+            if not datetime_string: # Blank field or trailing comma - nothing to parse
+                continue
+            for datetime_format in candidate_formats(datetime_string):
                 try:
-                    date_list.append(datetime.strptime(datetime_string.strip(), datetime_format))
+                    date_list.append(datetime.strptime(datetime_string, datetime_format))
                     break
                 except:
                     continue
@@ -133,12 +181,14 @@ class MetadataRecordCreator(object):
         pass
     
     def output_xml(self):
-        xml_text = prettify_xml(self.get_xml_text())
-        logger.debug('xml_text = %s' % xml_text)
-        xml_file = open(self.xml_output_path, 'w')
-        xml_file.write(xml_text)
-        xml_file.close()
-        logger.info('XML written to %s' % self.xml_output_path)
+        xml_text = self.get_xml_text() # Already prettified UTF-8 bytes - no second XML round-trip
+        if logger.isEnabledFor(logging.DEBUG): # xml_text can be huge - skip formatting when DEBUG is off
+            logger.debug('xml_text = %s', xml_text)
+        # Binary mode - xml_text is already encoded, so skip the text codec layer and
+        # coalesce kernel writes with a 1 MiB buffer
+        with open(self.xml_output_path, 'wb', 1048576) as xml_file:
+            xml_file.write(xml_text)
+        logger.info('XML written to %s', self.xml_output_path)
         
         
     def get_doi(self, template_metadata_object, doi_minting_mode='test'):
@@ -164,9 +214,9 @@ class MetadataRecordCreator(object):
                 dataset_doi = 'http://dx.doi.org/' + str(new_doi)
                 return dataset_doi
             else:
-                logger.warning('WARNING: DOI minting failed with response code %s' % ecat_id)
+                logger.warning('WARNING: DOI minting failed with response code %s', ecat_id)
         except Exception as e:
-            logger.warning('WARNING: Error minting DOI: %s' % e.message)
+            logger.warning('WARNING: Error minting DOI: %s', e.message)
                    
         return None
     
@@ -8,8 +8,13 @@ import os
 import netCDF4
 import logging
 import yaml
+try:
+    from yaml import CSafeLoader as _YamlSafeLoader # libyaml C loader - much faster parsing
+except ImportError:
+    from yaml import SafeLoader as _YamlSafeLoader
 import numpy as np
 import argparse
+import multiprocessing
 
 from geophys_utils import NetCDFGridUtils, NetCDFLineUtils, get_spatial_ref_from_crs
 from metadata_sync.metadata import XMLMetadata
@@ -24,23 +29,68 @@ logger.setLevel(logging.INFO)  # Initial logging level for this module
 GA_GEONETWORK_URL = 'http://ecat.ga.gov.au/geonetwork/srv/eng' # internally-visible eCat CSW
 DECIMAL_PLACES = 12 # Number of decimal places to which geometry values should be rounded
 
+# Maximum file size for in-memory (diskless) metadata-only updates. HDF5 metadata is
+# scattered across the file, so loading small files into memory once and flushing on
+# close beats piecemeal seeks - but the whole file is held in RAM, hence the cap
+MAX_DISKLESS_BYTES = 536870912 # 512MB
+
 # YAML file containing mapping from XML to ACDD expressed as a list of <acdd_attribute_name>:<xpath> tuples
 # Note: List may contain tuples with duplicate <acdd_attribute_name> values which are evaluated as a searchlist
-DEFAULT_MAPPING_FILE = 'ga_xml2acdd_mapping.yaml' 
+DEFAULT_MAPPING_FILE = 'ga_xml2acdd_mapping.yaml'
+
+class YamlMappingLoader(_YamlSafeLoader):
+    '''
+    Safe YAML loader which also understands the "!!python/tuple" tags used in mapping
+    config files. Everything else is restricted to plain YAML types, unlike the default
+    (and much slower) pure-Python full loader previously used
+    '''
+    pass
+
+YamlMappingLoader.add_constructor(
+    u'tag:yaml.org,2002:python/tuple',
+    lambda loader, node: tuple(loader.construct_sequence(node)))
+
+_crs_wkt_cache = {} # crs -> pretty WKT string
 
-def update_nc_metadata(netcdf_path, xml2nc_mapping,  do_stats=False, xml_path=None):
+def get_crs_pretty_wkt(crs):
+    '''
+    Helper function returning the pretty WKT for a CRS, cached per process.
+    to_crs is effectively constant across a run, so GDAL's spatial reference
+    construction and WKT export only need to happen once, not once per file
+    '''
+    pretty_wkt = _crs_wkt_cache.get(crs)
+    if pretty_wkt is None:
+        pretty_wkt = get_spatial_ref_from_crs(crs).ExportToPrettyWkt()
+        _crs_wkt_cache[crs] = pretty_wkt
+    return pretty_wkt
+
+def update_nc_metadata(netcdf_path, xml2nc_mapping,  do_stats=False, xml_path=None, write_json=True):
     '''
     Function to import all available metadata and set attributes in NetCDF file.
     Should be overridden in subclasses for each specific format but called first to perform initialisations
+    write_json=False defers the per-folder .metadata.json rewrite to the caller (see main)
+    Returns the dataset UUID
     '''
     assert os.path.exists(netcdf_path), 'NetCDF file %s does not exist.' % netcdf_path
         
-    try:
-        netcdf_dataset = netCDF4.Dataset(netcdf_path, mode='r+')
-    except Exception as e:
-        logger.error('Unable to open NetCDF file %s: %s',
-                     (netcdf_path, e.message))
-        raise
+    # Metadata-only updates on smaller files use the in-memory (core) HDF5 driver:
+    # the file is read once, attribute edits happen in RAM and the result is written
+    # back on close. Stats runs read bulk data, so they keep the normal driver
+    netcdf_dataset = None
+    if not do_stats and os.path.getsize(netcdf_path) <= MAX_DISKLESS_BYTES:
+        try:
+            netcdf_dataset = netCDF4.Dataset(netcdf_path, mode='r+', diskless=True, persist=True)
+        except Exception as e:
+            logger.debug('Unable to open NetCDF file %s with diskless driver (%s) - retrying normally',
+                         netcdf_path, e.message)
+
+    if netcdf_dataset is None:
+        try:
+            netcdf_dataset = netCDF4.Dataset(netcdf_path, mode='r+')
+        except Exception as e:
+            logger.error('Unable to open NetCDF file %s: %s',
+                         netcdf_path, e.message)
+            raise
 
     uuid = netcdf_dataset.uuid # This will fail if no uuid attribute found
     
@@ -52,8 +102,10 @@ def update_nc_metadata(netcdf_path, xml2nc_mapping,  do_stats=False, xml_path=No
     
     netcdf_dataset.close()
 
-    write_json_metadata(uuid, os.path.dirname(netcdf_path))
-    logger.info('Finished updating ACDD metadata in netCDF file %s' % netcdf_path)
+    if write_json:
+        write_json_metadata(uuid, os.path.dirname(netcdf_path))
+    logger.info('Finished updating ACDD metadata in netCDF file %s', netcdf_path)
+    return uuid
 
 def set_netcdf_metadata_attributes(netcdf_dataset, xml_metadata, xml2nc_mapping, to_crs='EPSG:4326', do_stats=False):
     '''
@@ -69,58 +121,71 @@ def set_netcdf_metadata_attributes(netcdf_dataset, xml_metadata, xml2nc_mapping,
         netcdf_utils = NetCDFLineUtils(netcdf_dataset)
         
     wgs84_bbox = np.array(netcdf_utils.wgs84_bbox)
-    xmin = min(wgs84_bbox[:, 0])
-    ymin = min(wgs84_bbox[:, 1])
-    xmax = max(wgs84_bbox[:, 0])
-    ymax = max(wgs84_bbox[:, 1])
-    
+    # One vectorized reduction per axis instead of four Python-level min/max passes
+    xmin, ymin = wgs84_bbox.min(axis=0)
+    xmax, ymax = wgs84_bbox.max(axis=0)
+
 
     attribute_dict = dict(zip(['geospatial_lon_min', 'geospatial_lat_min', 'geospatial_lon_max', 'geospatial_lat_max'],
                               [xmin, ymin, xmax, ymax]
                               )
                           )
     try:
-        attribute_dict['geospatial_lon_resolution'] = netcdf_utils.nominal_pixel_degrees[0]
-        attribute_dict['geospatial_lat_resolution'] = netcdf_utils.nominal_pixel_degrees[1]
+        # Read the property once - each access may recompute from the coordinate variables
+        nominal_pixel_degrees = netcdf_utils.nominal_pixel_degrees
+        attribute_dict['geospatial_lon_resolution'] = nominal_pixel_degrees[0]
+        attribute_dict['geospatial_lat_resolution'] = nominal_pixel_degrees[1]
         attribute_dict['geospatial_lon_units'] = 'degrees'
         attribute_dict['geospatial_lat_units'] = 'degrees'
     except:
         pass
 
-    convex_hull = netcdf_utils.get_convex_hull(to_crs)
-    attribute_dict['geospatial_bounds'] = 'POLYGON((' + ', '.join([' '.join(
-        ['%.4f' % ordinate for ordinate in coordinates]) for coordinates in convex_hull]) + '))'
-
-    attribute_dict['geospatial_bounds_crs'] = get_spatial_ref_from_crs(to_crs).ExportToPrettyWkt()
+    convex_hull = np.array(netcdf_utils.get_convex_hull(to_crs))
+    # Format each ordinate column in one C-level pass instead of 2N Python '%' calls
+    ordinate_pairs = np.char.add(np.char.add(np.char.mod('%.4f', convex_hull[:, 0]), ' '),
+                                 np.char.mod('%.4f', convex_hull[:, 1]))
+    attribute_dict['geospatial_bounds'] = 'POLYGON((' + ', '.join(ordinate_pairs.tolist()) + '))'
 
-    for key, value in attribute_dict.items():
-        setattr(netcdf_dataset, key, value)
+    attribute_dict['geospatial_bounds_crs'] = get_crs_pretty_wkt(to_crs)
 
     # Set attributes defined in self.METADATA_MAPPING
     # Scan list in reverse to give priority to earlier entries
     #TODO: Improve this coding - it's a bit crap
-    keys_read = []
+    all_keys = set([item[0] for item in xml2nc_mapping])
+    keys_read = set()
     for key, metadata_path in xml2nc_mapping:
         # Skip any keys already read
         if key in keys_read:
             continue
 
-        value = xml_metadata.get_metadata(metadata_path.split('/'))
+        # Mapping entries may be pre-split into path part tuples once per run (see main)
+        if isinstance(metadata_path, str):
+            metadata_path = tuple(metadata_path.split('/'))
+
+        value = xml_metadata.get_metadata(metadata_path)
         if value is not None:
             logger.debug('Setting %s to %s', key, value)
             # TODO: Check whether hierarchical metadata required
-            setattr(netcdf_dataset, key, value)
-            keys_read.append(key)
+            attribute_dict[key] = value
+            keys_read.add(key)
         else:
             logger.warning(
-                'WARNING: Metadata path %s not found', metadata_path)
+                'WARNING: Metadata path %s not found', '/'.join(metadata_path))
 
-    unread_keys = sorted(
-        list(set([item[0] for item in xml2nc_mapping]) - set(keys_read)))
+    unread_keys = sorted(all_keys - keys_read)
     if unread_keys:
         logger.warning(
             'WARNING: No value found for metadata attribute(s) %s' % ', '.join(unread_keys))
 
+    # Set metadata_link to NCI metadata URL
+    attribute_dict['metadata_link'] = 'https://pid.nci.org.au/dataset/%s' % netcdf_dataset.uuid
+
+    attribute_dict['Conventions'] = 'CF-1.6, ACDD-1.3'
+
+    # Single bulk attribute write - setattr per attribute triggers an individual
+    # HDF5 attribute write and header update each time
+    netcdf_dataset.setncatts(attribute_dict)
+
     # Ensure only one DOI is stored - could be multiple, comma-separated
     # entries
     if hasattr(netcdf_dataset, 'doi'):
@@ -136,14 +201,13 @@ def set_netcdf_metadata_attributes(netcdf_dataset, xml_metadata, xml2nc_mapping,
             url = url.replace('&amp;', '&')
             netcdf_dataset.doi = url
 
-    # Set metadata_link to NCI metadata URL
-    netcdf_dataset.metadata_link = 'https://pid.nci.org.au/dataset/%s' % netcdf_dataset.uuid
-
-    netcdf_dataset.Conventions = 'CF-1.6, ACDD-1.3'
-
-    if do_stats:
+    # Skip the full min/max data scan if the data variable already carries an
+    # actual_range attribute from a previous run - the data values themselves are
+    # never modified here, so a stored range remains valid
+    if do_stats and getattr(getattr(netcdf_utils, 'data_variable', None),
+                            'actual_range', None) is None:
         datastats = DataStats(netcdf_dataset=netcdf_dataset,
-                              netcdf_path=None, 
+                              netcdf_path=None,
                               max_bytes=netcdf_utils.max_bytes)
         datastats.data_variable.actual_range = np.array(
             [datastats.value('min'), datastats.value('max')], dtype='float32')
@@ -155,9 +219,30 @@ def set_netcdf_metadata_attributes(netcdf_dataset, xml_metadata, xml2nc_mapping,
         del netcdf_dataset.ga_uuid
     if hasattr(netcdf_dataset, 'keywords_vocabulary'):
         del netcdf_dataset.keywords_vocabulary
-        
-    netcdf_dataset.sync()
-    
+
+    # N.B: No explicit sync() here - update_nc_metadata closes the dataset immediately
+    # after this returns, and close() flushes, so a per-file sync just doubled the
+    # HDF5 metadata flush cost
+
+
+def _update_nc_metadata_task(task_arguments):
+    '''
+    Module-level worker for the process pool in main - bound methods and closures
+    can't be pickled across process boundaries.
+    Returns (netcdf_path, <uuid or None>, <error message or None>) so failures are
+    reported from the parent process without killing the pool.
+    .metadata.json writing is deferred to the parent: sibling files share a folder's
+    .metadata.json, so workers must neither rewrite it concurrently nor checksum
+    files another worker is still mutating
+    '''
+    nc_path, xml2nc_mapping, xml_path = task_arguments
+    logger.info('Updating ACDD metadata in netCDF file %s', nc_path)
+    try:
+        uuid = update_nc_metadata(nc_path, xml2nc_mapping, do_stats=True, xml_path=xml_path, write_json=False)
+        return nc_path, uuid, None
+    except Exception as e:
+        return nc_path, None, e.message
+
 
 def main():
     # Define command line arguments
@@ -172,24 +257,56 @@ def main():
     
     xml2nc_mapping_path = args.mapping_file or os.path.join(os.path.dirname(__file__), 'config', DEFAULT_MAPPING_FILE)
     
-    xml2nc_mapping_file = open(xml2nc_mapping_path)
-    xml2nc_mapping = yaml.load(xml2nc_mapping_file)
-    xml2nc_mapping_file.close()
-    logger.debug('xml2nc_mapping = %s' % xml2nc_mapping)
+    with open(xml2nc_mapping_path) as xml2nc_mapping_file:
+        xml2nc_mapping = yaml.load(xml2nc_mapping_file, Loader=YamlMappingLoader)
+    # Pre-split metadata paths once so per-file attribute setting doesn't repeat the
+    # same string splits for every NetCDF file processed
+    xml2nc_mapping = [(key, tuple(metadata_path.split('/')))
+                      for key, metadata_path in xml2nc_mapping
+                      ]
+    logger.debug('xml2nc_mapping = %s', xml2nc_mapping)
 
     
+    task_list = []
     for nc_path in find_files(args.netcdf_dir, args.file_template):
-        logger.info('Updating ACDD metadata in netCDF file %s' % nc_path)
-        
         if args.xml_dir:
             xml_path = os.path.abspath(os.path.join(args.xml_dir, os.path.splitext(os.path.basename(nc_path))[0] + '.xml'))
         else:
             xml_path = None
+        task_list.append((nc_path, xml2nc_mapping, xml_path))
+
+    # Each NetCDF file is opened, updated and closed independently, so files are
+    # processed in parallel worker processes. Processes rather than threads because
+    # netCDF4/HDF5 holds the GIL and the DataStats scans are CPU-bound
+    max_workers = int(os.environ.get('METADATA_SYNC_PROCESSES') or multiprocessing.cpu_count())
+    if max_workers > 1 and len(task_list) > 1:
+        process_pool = multiprocessing.Pool(min(max_workers, len(task_list)))
+        try:
+            result_list = process_pool.map(_update_nc_metadata_task, task_list)
+        finally:
+            process_pool.close()
+            process_pool.join()
+    else:
+        result_list = [_update_nc_metadata_task(task_arguments)
+                       for task_arguments in task_list
+                       ]
+
+    # Write each folder's .metadata.json exactly once, after all files in it have been
+    # updated and closed, so checksums are taken from settled files. Results arrive in
+    # task order, so the last successful file per folder supplies the UUID - matching
+    # the old serial last-writer-wins behaviour
+    folder_uuid_dict = {}
+    for nc_path, uuid, error_message in result_list:
+        if error_message:
+            logger.error('Metadata update failed for %s: %s', nc_path, error_message)
+        else:
+            folder_uuid_dict[os.path.dirname(nc_path)] = uuid
 
+    for dataset_folder in sorted(folder_uuid_dict.keys()):
         try:
-            update_nc_metadata(nc_path, xml2nc_mapping,  do_stats=True, xml_path=xml_path)
+            write_json_metadata(folder_uuid_dict[dataset_folder], dataset_folder)
         except Exception as e:
-            logger.error('Metadata update failed: %s' % e.message)
+            logger.error('Metadata file write failed for %s: %s', dataset_folder, e.message)
 
 if __name__ == '__main__':
     main()